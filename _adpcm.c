@@ -0,0 +1,146 @@
+/*
+ * C implementation of the MS ADPCM data chunk decoder.
+ *
+ * Optional fast path for convert_ADPCM.py on deployment targets where
+ * Numba's import and JIT compile cost is unacceptable (serverless cold
+ * starts). Build in place with:
+ *
+ *     python3 setup.py build_ext --inplace
+ *
+ * The decode loop mirrors _decode_all in convert_ADPCM.py and must
+ * produce bit-identical output.
+ */
+
+#include <Python.h>
+#include <stdint.h>
+
+/* Intel ADPCM step variation table. */
+static const int8_t index_table[16] = {
+    -1, -1, -1, -1, 2, 4, 6, 8,
+    -1, -1, -1, -1, 2, 4, 6, 8 };
+
+static const int16_t step_size_table[89] = {
+    7, 8, 9, 10, 11, 12, 13, 14, 16, 17,
+    19, 21, 23, 25, 28, 31, 34, 37, 41, 45,
+    50, 55, 60, 66, 73, 80, 88, 97, 107, 118,
+    130, 143, 157, 173, 190, 209, 230, 253, 279, 307,
+    337, 371, 408, 449, 494, 544, 598, 658, 724, 796,
+    876, 963, 1060, 1166, 1282, 1411, 1552, 1707, 1878, 2066,
+    2272, 2499, 2749, 3024, 3327, 3660, 4026, 4428, 4871, 5358,
+    5894, 6484, 7132, 7845, 8630, 9493, 10442, 11487, 12635, 13899,
+    15289, 16818, 18500, 20350, 22385, 24623, 27086, 29794, 32767 };
+
+/* decode_all(raw, block_align, out)
+ *
+ * raw is the ADPCM data chunk, out a writable buffer of native int16
+ * samples sized for the whole decoded file (one header sample plus two
+ * samples per data byte for every packet). */
+static PyObject *
+decode_all(PyObject *self, PyObject *args)
+{
+    Py_buffer raw, out;
+    int block_align;
+
+    if (!PyArg_ParseTuple(args, "y*iw*", &raw, &block_align, &out))
+        return NULL;
+
+    /* A 4 byte block is a degenerate but valid packet: header only,
+     * no sample data. Only smaller alignments are impossible. */
+    if (block_align < 4) {
+        PyBuffer_Release(&raw);
+        PyBuffer_Release(&out);
+        PyErr_SetString(PyExc_ValueError, "block alignment too small");
+        return NULL;
+    }
+
+    const uint8_t *in = (const uint8_t *)raw.buf;
+    int16_t *samples = (int16_t *)out.buf;
+    Py_ssize_t n_bytes = raw.len;
+    Py_ssize_t out_max = out.len / 2;
+    Py_ssize_t out_pos = 0;
+    Py_ssize_t packet_pos = 0;
+
+    /* Check the output buffer size once, before decoding. */
+    if (n_bytes > 0) {
+        Py_ssize_t n_packets = (n_bytes + block_align - 1) / block_align;
+        Py_ssize_t last_len = n_bytes - (n_packets - 1) * block_align;
+        Py_ssize_t total = (n_packets - 1) * (2 * (block_align - 4) + 1)
+            + 2 * (last_len - 4) + 1;
+        if (last_len < 4 || total > out_max) {
+            PyBuffer_Release(&raw);
+            PyBuffer_Release(&out);
+            PyErr_SetString(PyExc_ValueError,
+                "output buffer too small for data chunk");
+            return NULL;
+        }
+    }
+
+    while (packet_pos < n_bytes) {
+        Py_ssize_t packet_end = packet_pos + block_align;
+        if (packet_end > n_bytes)
+            packet_end = n_bytes;
+
+        /* First two bytes of packet is the first sample value (little
+         * endian signed). Third byte is the index in step table of the
+         * current step. Fourth byte is empty. */
+        int valpred = in[packet_pos] | (in[packet_pos + 1] << 8);
+        if (valpred >= 32768)
+            valpred -= 65536;
+        int index = in[packet_pos + 2];
+        if (index > 88)
+            index = 88;
+        samples[out_pos++] = (int16_t)valpred;
+
+        /* Remaining bytes hold two 4 bit codes each, low order nybble
+         * first. */
+        for (Py_ssize_t i = packet_pos + 4; i < packet_end; i++) {
+            for (int j = 0; j < 2; j++) {
+                int delta = (in[i] >> (j << 2)) & 0x0f;
+
+                int step_size = step_size_table[index];
+
+                /* Find new index value (for next iteration). */
+                index += index_table[delta];
+                if (index < 0) index = 0;
+                else if (index > 88) index = 88;
+
+                /* Compute difference and new predicted value. */
+                int difference = step_size >> 3;
+                if (delta & 1) difference += step_size >> 2;
+                if (delta & 2) difference += step_size >> 1;
+                if (delta & 4) difference += step_size;
+                if (delta & 8) valpred -= difference;
+                else valpred += difference;
+
+                /* Clamp output value. */
+                if (valpred < -32768) valpred = -32768;
+                else if (valpred > 32767) valpred = 32767;
+
+                samples[out_pos++] = (int16_t)valpred;
+            }
+        }
+
+        packet_pos = packet_end;
+    }
+
+    PyBuffer_Release(&raw);
+    PyBuffer_Release(&out);
+    Py_RETURN_NONE;
+}
+
+static PyMethodDef adpcm_methods[] = {
+    {"decode_all", decode_all, METH_VARARGS,
+     "Decode a whole MS ADPCM data chunk into an int16 sample buffer."},
+    {NULL, NULL, 0, NULL}
+};
+
+static struct PyModuleDef adpcm_module = {
+    PyModuleDef_HEAD_INIT, "_adpcm",
+    "C decoder for MS ADPCM data chunks.", -1, adpcm_methods
+};
+
+PyMODINIT_FUNC
+PyInit__adpcm(void)
+{
+    return PyModule_Create(&adpcm_module);
+}
@@ -1,4 +1,4 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 
 """
 ***
@@ -11,7 +11,8 @@
 *** run under AppEngine.
 ***
 *** Version: 0.9 (first GitHub version to publish)
-*** Written for AppEngine's Python 2.7 environment
+*** Written for Python 3 (originally AppEngine's Python 2.7
+*** environment)
 ***
 *** Author: Peter Marshall
 ***
@@ -27,15 +28,50 @@
 """
 
 import struct
-from StringIO import StringIO
+import sys
+from array import array
+from io import BytesIO
+
+# NumPy and Numba are optional, and independently so: with both present
+# the chunk decoder runs as LLVM-compiled machine code, with NumPy alone
+# the vectorized decoder below is used, and with neither the pure Python
+# decoder is used (e.g. on AppEngine, where C extensions are
+# unavailable).
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+    prange = range
+
+# Prebuilt C decoder (see _adpcm.c; built via setup.py). Preferred over
+# Numba when present because it carries no JIT compile or import cost,
+# which matters for cold starts on small files.
+try:
+    import _adpcm
+except ImportError:
+    _adpcm = None
+
+# Precompiled struct formats, so the format string is parsed once at
+# import instead of on every header field and every packet.
+_S_h = struct.Struct('<h')
+_S_H = struct.Struct('<H')
+_S_L = struct.Struct('<L')
 
 
 # Intel ADPCM step variation table.
-index_table = [
+# Stored as typed arrays of machine integers: lookups skip the boxed
+# int objects a plain list holds, and the footprint drops from ~28
+# bytes per entry to 1 or 2.
+index_table = array('b', [
     -1, -1, -1, -1, 2, 4, 6, 8,
-    -1, -1, -1, -1, 2, 4, 6, 8 ]
+    -1, -1, -1, -1, 2, 4, 6, 8 ])
 
-step_size_table = [
+step_size_table = array('h', [
     7, 8, 9, 10, 11, 12, 13, 14, 16, 17,
     19, 21, 23, 25, 28, 31, 34, 37, 41, 45,
     50, 55, 60, 66, 73, 80, 88, 97, 107, 118,
@@ -44,80 +80,188 @@ step_size_table = [
     876, 963, 1060, 1166, 1282, 1411, 1552, 1707, 1878, 2066,
     2272, 2499, 2749, 3024, 3327, 3660, 4026, 4428, 4871, 5358,
     5894, 6484, 7132, 7845, 8630, 9493, 10442, 11487, 12635, 13899,
-    15289, 16818, 18500, 20350, 22385, 24623, 27086, 29794, 32767 ]
+    15289, 16818, 18500, 20350, 22385, 24623, 27086, 29794, 32767 ])
+
+# Precomputed decode tables for the NumPy/Numba path.
+# diff_table[index, nybble] is the exact signed change applied to the
+# predictor for that nybble at that step size: the shift-and-add
+# magnitude chain of the scalar decoder evaluated up front for all
+# 89 step sizes x 16 nybble values. index_delta_table is index_table
+# as machine integers. The per-sample work then reduces to two table
+# lookups, two adds and two clamps.
+if np is not None:
+    _steps = np.array(step_size_table, dtype=np.int32)[:, None]
+    _nybs = np.arange(16)
+    _magnitude = ((_steps >> 3)
+        + np.where(_nybs & 1, _steps >> 2, 0)
+        + np.where(_nybs & 2, _steps >> 1, 0)
+        + np.where(_nybs & 4, _steps, 0))
+    diff_table = np.where(_nybs & 8, -_magnitude, _magnitude).astype(np.int32)
+    index_delta_table = np.array(index_table, dtype=np.int8)
+    del _steps, _nybs, _magnitude
+
+
+# Decompresses an entire data chunk from MS ADPCM to Linear PCM 16 bit.
+# raw is the uint8 view of the data chunk and out is the preallocated
+# int16 sample array for the whole file. Doing every packet in one
+# compiled call leaves a single Python-to-Numba boundary crossing per
+# file and gives LLVM the complete decode loop to optimize.
+# Each packet carries its own predictor state in its header, so packets
+# are independent: the loop runs under numba.prange, with every
+# iteration writing a disjoint slice of out.
+def _decode_all(raw, block_align, out):
+    n_bytes = raw.shape[0]
+    n_packets = (n_bytes + block_align - 1) // block_align
+    samples_per_packet = 2 * (block_align - 4) + 1
+
+    for p in prange(n_packets):
+        packet_pos = p * block_align
+        packet_end = min(packet_pos + block_align, n_bytes)
+        out_pos = p * samples_per_packet
 
+        # First two bytes of packet is the first sample value.
+        # Third byte is the index in step table of the current step.
+        # Fourth byte is empty.
+        valpred = int(raw[packet_pos]) | (int(raw[packet_pos + 1]) << 8)
+        if valpred >= 32768:
+            valpred -= 65536
+
+        # Clamp the header index: Numba compiles without bounds checks,
+        # so an out-of-range byte in a malformed file must not be
+        # allowed to index past the 89-row table.
+        index = min(int(raw[packet_pos + 2]), 88)
+        out[out_pos] = valpred
+        out_pos += 1
+
+        # Remaining bytes of packet are the subsequent sample values,
+        # two 4 bit codes per byte, low order nybble first.
+        for i in range(packet_pos + 4, packet_end):
+            for j in range(2):
+                nyb = (raw[i] >> (j << 2)) & 0x0f
+
+                # Compute new predicted value and clamp it. The table
+                # folds step size, sign and magnitude into one lookup.
+                valpred += diff_table[index, nyb]
+                valpred = min(max(valpred, -32768), 32767)
+
+                # Find new index value (for next iteration).
+                index += index_delta_table[nyb]
+                index = min(max(index, 0), 88)
+
+                # Add the output sample to buffer.
+                out[out_pos] = valpred
+                out_pos += 1
+
+if njit is not None:
+    _decode_all = njit(cache=True, parallel=True)(_decode_all)
+
+
+# Decompresses an entire data chunk with vectorized NumPy, for hosts
+# that have NumPy but not Numba. For a fixed step index sequence the
+# predictor is just a cumulative sum of table differences, so the only
+# serial Python work per sample is the index scan (one lookup, one add,
+# one clamp). Saturation is not linear, so any packet whose running sum
+# leaves the 16 bit range is redone with the exact scalar decoder;
+# typical audio stays in range.
+def _decode_all_vec(raw, block_align, out):
+    out_pos = 0
+    for packet_pos in range(0, len(raw), block_align):
+        packet = raw[packet_pos:packet_pos + block_align]
+        valpred = _S_h.unpack_from(packet, 0)[0]
+        # Clamp the header index like every other decode path does.
+        index = min(packet[2], 88)
+        out[out_pos] = valpred
+
+        # Split the packet into 4 bit codes, low order nybble first.
+        buf = np.frombuffer(packet, dtype=np.uint8, offset=4)
+        nybbles = np.empty(2 * len(buf), dtype=np.uint8)
+        nybbles[0::2] = buf & 0x0f
+        nybbles[1::2] = buf >> 4
+
+        # Serial scan of the step index sequence. Each sample's
+        # difference is taken at the index value before its own update.
+        indices = np.empty(len(nybbles), dtype=np.int32)
+        cur = index
+        for k, nyb in enumerate(nybbles.tolist()):
+            indices[k] = cur
+            cur += index_table[nyb]
+            cur = 0 if cur < 0 else 88 if cur > 88 else cur
+
+        # Predictor update as one gather plus one cumulative sum.
+        valpreds = np.cumsum(diff_table[indices, nybbles], dtype=np.int64)
+        valpreds += valpred
+
+        if (len(valpreds) and
+                (valpreds.max() > 32767 or valpreds.min() < -32768)):
+            # The packet saturated somewhere; redo it exactly.
+            convert_packet(packet[4:], valpred, index, out, out_pos)
+        else:
+            out[out_pos + 1:out_pos + 1 + len(valpreds)] = valpreds
+        out_pos += len(nybbles) + 1
 
 
-# Ensure that a value is within a given range.
-def clamp(value, lower_limit, upper_limit):
-    return (lower_limit if value < lower_limit
-       else upper_limit if value > upper_limit
-       else value)
+# Fused decode table for the pure Python decoder.
+# delta_table[index][nybble] is the signed predictor change, folding the
+# nybble's sign bit and the difference chain ((step >> 3) plus
+# conditional shift-and-add terms) into a single lookup -- the list
+# counterpart of the NumPy path's diff_table. The chain is precomputed
+# term by term rather than as a single multiply-and-shift, which would
+# round differently.
+delta_table = [
+    [(-1 if n & 8 else 1)
+        * ((step >> 3) + (step >> 2 if n & 1 else 0)
+            + (step >> 1 if n & 2 else 0) + (step if n & 4 else 0))
+        for n in range(16)]
+    for step in step_size_table]
 
 
 # Decompresses a single packet from MS ADPCM to Linear PCM 16 bit.
-def convert_packet(data_in, valpred, index):
-    size = 2   # always 2 bytes (16 bits) per sample
-    data_in_len = len(data_in)
-    data_in_index = 0
-
-    # 2 bytes per output sample * one byte of input yields two samples * length
-    # of input buffer in bytes.
-    # Plus one extra sample that we get from the state passed in.
-    data_out_len = size * 2 * data_in_len + 2
-    data_out = bytearray(data_out_len)
-
+# Samples are written into data_out (a preallocated signed 16 bit array
+# covering the whole file) starting at sample position out_pos, so the
+# per-packet output allocations disappear. Returns the updated
+# predictor state.
+def convert_packet(data_in, valpred, index, data_out, out_pos):
     # First sample is what was passed in as state.
     # That value came from the packet header.
-    data_out[0:2] = struct.pack('<h', valpred)
+    data_out[out_pos] = valpred
 
-    buffer_step = True
-    for i in range(2, data_out_len, size):
+    # Unpack the delta values up front: each input byte holds two 4 bit
+    # codes, low order nybble first. Building the whole nybble sequence
+    # in one pass replaces the per-sample fetch/toggle logic and leaves
+    # the main loop as a straight line predictor update.
+    buf = bytearray(data_in)
+    nybbles = bytearray(2 * len(buf))
+    nybbles[0::2] = [b & 0x0f for b in buf]
+    nybbles[1::2] = [b >> 4 for b in buf]
 
-        # Get the delta value.
-        # Buffer step is an alternating boolean that indicates either fetching a new
-        # byte or reading from existing byte (because each sample is a 4 bit value).
-        # Low order nybble is processed first, then high order nybble.
-        if not buffer_step:
-            delta = (input_buffer >> 4) & 0x0f
-        else:
-            input_buffer = ord(data_in[data_in_index])
-            data_in_index += 1
-            delta = input_buffer & 0x0f
-        buffer_step = not buffer_step
+    for k, delta in enumerate(nybbles, 1):
 
-        # Set current step size.
-        step_size = step_size_table[index]
+        # Compute new predicted value: the signed difference comes from
+        # a single fused table lookup.
+        valpred += delta_table[index][delta]
 
         # Find new index value (for next iteration).
+        # Clamping is inlined: a function call per sample costs more
+        # than the comparison itself.
         index += index_table[delta]
-        index = clamp(index, 0, 88)
-
-        # Separate sign and magnitude.
-        # The high bit is the sign and the rest is the magnitude.
-        sign = delta & 8
-        delta = delta & 7
-
-        # Compute difference and new predicted value.
-        difference = (step_size >> 3);
-        if delta & 1:
-            difference += (step_size >> 2)
-        if delta & 2:
-            difference += (step_size >> 1)
-        if delta & 4:
-            difference += step_size
-        if sign:
-            valpred -= difference
-        else:
-            valpred += difference
+        index = 0 if index < 0 else 88 if index > 88 else index
 
         # Clamp output value.
-        valpred = clamp(valpred, -32768, 32767)
+        valpred = (-32768 if valpred < -32768
+            else 32767 if valpred > 32767 else valpred)
 
         # Add the output sample to buffer.
-        data_out[i:i+2] = struct.pack('<h', valpred)
+        data_out[out_pos + k] = valpred
+
+    return valpred, index
 
-    return data_out, valpred, index
+
+# Data chunks smaller than this decode with the pure Python path even
+# when Numba is available: the first-call JIT compile and the per-call
+# dispatch overhead outweigh interpreting a few KB of audio. 16KB of
+# ADPCM is several seconds of 8kHz speech, comfortably above the short
+# clips the Speech API use case sends.
+SMALL_CHUNK_THRESHOLD = 16384
 
 
 # Read the data chunk of a WAV file, decompressing each packet
@@ -126,27 +270,72 @@ def convert_packet(data_in, valpred, index):
 # of the data chunk.
 def convert_file(file_in, file_out, data_in_len, block_align):
     assert data_in_len > 0 and block_align > 0
-    bytes_read = 0
-    bytes_written = 0
-
-    while bytes_read < data_in_len:
-        this_packet = file_in.read(block_align)
-        bytes_read += len(this_packet)
 
-        # First two bytes of packet is the first sample value.
-        # Third byte is the index in step table of the current step.
-        # Fourth byte is empty.
-        # Remaining bytes of packet are the subsequent sample values.
-        first_sample = struct.unpack('<h', this_packet[0:2])[0]
-        index = ord(this_packet[2])
-        packet_data = this_packet[4:]
-
-        packet_out, _, _ = convert_packet(packet_data, first_sample, index)
-
-        file_out.write(packet_out)
-        bytes_written += len(packet_out)
+    # Read the whole data chunk in one call and carve packets out of it
+    # with memoryview slices. Reading and writing per packet costs one
+    # syscall pair for every few hundred bytes of audio.
+    raw = memoryview(file_in.read(data_in_len))
+
+    # A trailing fragment shorter than the 4 byte packet header cannot
+    # be decoded. Reject it up front, for every decode path alike: the
+    # compiled decoder runs without bounds checks and must never see
+    # such a chunk, and the output buffer sizing below assumes at least
+    # a header per packet.
+    if len(raw) % block_align in (1, 2, 3):
+        raise Exception('Not a valid WAV file.')
+
+    # Preallocate one int16 buffer covering every sample in the file:
+    # each packet contributes one header sample plus two samples per
+    # data byte, and only the last packet may be short.
+    n_packets = (len(raw) + block_align - 1) // block_align
+    last_packet_len = len(raw) - (n_packets - 1) * block_align
+    total_samples = ((n_packets - 1) * (2 * (block_align - 4) + 1)
+        + 2 * (last_packet_len - 4) + 1)
+    # The prebuilt C decoder has no warm-up cost, so it handles any
+    # size; the Numba and vectorized paths only pay off once the chunk
+    # is big enough to amortize their fixed setup costs.
+    large_chunk = len(raw) >= SMALL_CHUNK_THRESHOLD
+    if _adpcm is not None:
+        # Prebuilt C decoder: one call for the whole chunk.
+        out_all = array('h', bytes(2 * total_samples))
+        _adpcm.decode_all(raw, block_align, out_all)
+    elif njit is not None and large_chunk:
+        # One compiled call decodes every packet in the chunk.
+        out_all = np.empty(total_samples, dtype=np.int16)
+        _decode_all(np.frombuffer(raw, dtype=np.uint8), block_align, out_all)
+    elif np is not None and large_chunk:
+        # NumPy without Numba: vectorized cumulative-sum decode.
+        out_all = np.empty(total_samples, dtype=np.int16)
+        _decode_all_vec(raw, block_align, out_all)
+    else:
+        out_all = array('h', bytes(2 * total_samples))
+        out_pos = 0
+        for packet_pos in range(0, len(raw), block_align):
+            this_packet = raw[packet_pos:packet_pos + block_align]
+
+            # First two bytes of packet is the first sample value.
+            # Third byte is the index in step table of the current step,
+            # clamped to the table range like every other decode path.
+            # Fourth byte is empty.
+            # Remaining bytes of packet are the subsequent sample values.
+            first_sample = _S_h.unpack_from(this_packet, 0)[0]
+            index = min(this_packet[2], 88)
+
+            convert_packet(this_packet[4:], first_sample, index,
+                out_all, out_pos)
+            out_pos += 2 * (len(this_packet) - 4) + 1
+
+    # The WAV format wants little endian samples; the buffer is stored
+    # in native order, so swap once on big endian hosts.
+    if sys.byteorder == 'big':
+        if isinstance(out_all, array):
+            out_all.byteswap()
+        else:
+            out_all.byteswap(True)
 
-    return bytes_written
+    # One write for the whole decoded chunk.
+    file_out.write(out_all.tobytes())
+    return 2 * total_samples
 
 
 # Given a WAV file, position file to start of data chunk and determine length.
@@ -155,34 +344,35 @@ def wav_find_data_chunk(file_in, file_out):
     # Read WAVE and fmt headers.
     front_headers = file_in.read(36)
 
-    # A valid WAV file will have standard headers at beginning. 
-    if not (front_headers[0:4] == 'RIFF' and
-            front_headers[8:12] == 'WAVE' and 
-            front_headers[12:16] == 'fmt '): 
+    # A valid WAV file will have standard headers at beginning.
+    if not (front_headers.startswith(b'RIFF') and
+            front_headers[8:12] == b'WAVE' and
+            front_headers[12:16] == b'fmt '):
          raise Exception('Not a valid WAV file.')
 
-    audio_format = struct.unpack('<H', front_headers[20:22])[0]
-    num_channels = struct.unpack('<H', front_headers[22:24])[0]
-    sample_rate = struct.unpack('<L', front_headers[24:28])[0]
-    block_align = struct.unpack('<H', front_headers[32:34])[0]
+    audio_format = _S_H.unpack_from(front_headers, 20)[0]
+    num_channels = _S_H.unpack_from(front_headers, 22)[0]
+    sample_rate = _S_L.unpack_from(front_headers, 24)[0]
+    block_align = _S_H.unpack_from(front_headers, 32)[0]
 
     # We can only process a 1-channel (mono) MS ADPCM file. 
     if not (num_channels == 1 and audio_format in [2,17]): 
          raise Exception('Only a 1-channel (mono) MS ADPCM file can be processed.')
 
     # Amend the fmt header for linear PCM.
-    # Write new front headers as output.
+    # The headers are not written until the data chunk is found, because
+    # the chunk sizes are filled in first (see below).
     new_headers = bytearray(front_headers)
     new_headers[20:22] = [1, 0]    # linear PCM
     new_headers[32:34] = [2, 0]    # block alignment in bytes
     new_headers[34:36] = [16, 0]   # bits per sample
-    new_headers[16:20] = struct.pack('<L', 16)    # fmt chunk size
-    new_headers[28:32] = struct.pack('<L', 2 * sample_rate)    # byte rate
-    file_out.write(new_headers)
+    new_headers[16:20] = _S_L.pack(16)    # fmt chunk size
+    new_headers[28:32] = _S_L.pack(2 * sample_rate)    # byte rate
 
-    # Determine total size of input file.
-    file_in.seek(0, 2)   # to EOF
-    in_file_size = file_in.tell()
+    # Determine total size of input file from the RIFF chunk size field,
+    # which covers everything after its own 8 byte header. This avoids
+    # a seek to EOF and back just to size the file.
+    in_file_size = 8 + _S_L.unpack_from(front_headers, 4)[0]
 
     # Iterate through chunks until we find the data chunk.
     next_chunk_pos = 12   # fixed location of first chunk
@@ -190,10 +380,25 @@ def wav_find_data_chunk(file_in, file_out):
         file_in.seek(next_chunk_pos)
         chunk_header = file_in.read(8)
         chunk_type = chunk_header[0:4]
-        chunk_length = struct.unpack('<L', chunk_header[4:8])[0]
-
-        if chunk_type == 'data':
-            file_out.write(chunk_header)
+        chunk_length = _S_L.unpack_from(chunk_header, 4)[0]
+
+        if chunk_type == b'data':
+            # The output size is fully determined by the input chunk
+            # size, so both chunk lengths can be written correctly up
+            # front: each packet yields one header sample plus two
+            # samples per data byte, at two bytes per sample. This
+            # keeps the output append-only (no seek-back patching), so
+            # it can stream to non-seekable sinks.
+            n_packets = chunk_length // block_align
+            last_packet_len = chunk_length % block_align
+            out_data_len = 2 * n_packets * (2 * (block_align - 4) + 1)
+            if last_packet_len:
+                out_data_len += 2 * (2 * (last_packet_len - 4) + 1)
+
+            new_headers[4:8] = _S_L.pack(36 + out_data_len)
+            file_out.write(new_headers)
+            file_out.write(b'data')
+            file_out.write(_S_L.pack(out_data_len))
             return chunk_length, block_align
 
         next_chunk_pos += 8 + chunk_length
@@ -203,37 +408,31 @@ def wav_find_data_chunk(file_in, file_out):
 
 # Main flow of control.
 def convert_linear16(file_name_in, file_name_out, file_in_data = None):
-    # Either use real files or memory files using StringIO.
+    # Either use real files or memory files using BytesIO.
     # Memory file is useful for AppEngine, which has a read-only file system.
     # !! Beware of file names chosen - there is no protection against
     # !! overwriting a file.
+    # A 1MB buffer lets the few large reads and writes go to the OS in
+    # big chunks rather than the default 8KB pieces.
     if file_name_in:
-        file_in = open(file_name_in,'rb')
+        file_in = open(file_name_in, 'rb', buffering=1 << 20)
     else:
-        file_in = StringIO(file_in_data)
+        file_in = BytesIO(file_in_data)
     if file_name_out:
-        file_out = open(file_name_out,'wb')
+        file_out = open(file_name_out, 'wb', buffering=1 << 20)
     else:
-        file_out = StringIO()
+        file_out = BytesIO()
 
+    # The headers are written with correct chunk lengths up front, so
+    # no seeking back to patch them afterwards.
     data_in_len, block_align = wav_find_data_chunk(file_in, file_out)
-    bytes_written = convert_file(file_in, file_out, data_in_len, block_align)
-
-    # Write the data chunk length.
-    file_out.seek(40)
-    file_out.write(struct.pack('<L', bytes_written))
-
-    # Write the entire WAV file's chunk length.
-    file_out.seek(0, 2)    # to EOF
-    out_file_size = file_out.tell()
-    file_out.seek(4)
-    file_out.write(struct.pack('<L', out_file_size - 8))
+    convert_file(file_in, file_out, data_in_len, block_align)
 
     file_in.close()
     if file_name_out:
         file_out.close()
     else:
-        # StringIO result can be referenced in calling function.
+        # BytesIO result can be referenced in calling function.
         return file_out.getvalue()
 
 
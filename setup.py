@@ -0,0 +1,18 @@
+#!/usr/bin/env python3
+
+# Builds the optional C decoder extension:
+#
+#     python3 setup.py build_ext --inplace
+#
+# convert_ADPCM.py falls back to Numba/NumPy or pure Python when the
+# extension has not been built.
+
+from setuptools import setup, Extension
+
+setup(
+    name='audio-file-formats',
+    version='0.9',
+    description='Convert ADPCM wave files to Linear PCM wave files.',
+    py_modules=['convert_ADPCM'],
+    ext_modules=[Extension('_adpcm', sources=['_adpcm.c'])],
+)